@@ -1,20 +1,53 @@
+from __future__ import annotations
+
 import streamlit as st
-import pandas as pd
-import requests
-import snowflake.connector
-from typing import Dict, Any, List, Optional
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Tuple
 import os
+import sys
 import time
 
+# pandas/requests/snowflake.connectorは重いため、使用する関数内で遅延インポート
+if TYPE_CHECKING:
+    import pandas as pd
+    import requests
+
+# .envファイルから環境変数を読み込む（オプション、HOSTの解決より先に実行）
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
 MAX_ATTEMPTS_MAIN = 100
 MAX_HINTS = 2
 
+# 正解（表記ゆれを許容、比較は前後空白除去・casefold済みの値で行う）
+CORRECT_ANSWER = "岡山県"
+ACCEPTED_ANSWERS = frozenset({"岡山県", "岡山", "okayama"})
+
 # Cortex Analyst設定
 DATABASE = "SNOWFLAKE_LEARNING_DB"
 SCHEMA = "CORTEX_ANALYST_DEMO"
 STAGE = "RAW_DATA"
 FILE = "semantic_model_J_CI_FD20.yaml"
 
+# 問題文
+PROBLEM_HTML = """
+<div style="background-color: #787c80; padding: 20px; border-radius: 10px; border-left: 5px solid #4169e1;">
+    <i>"序列に隠された真実への道標。<br/>
+その位置を正確に見抜くことで、データの扉は開かれる。"</i><br/><br/>
+
+2020年国勢調査が記した47都道府県の人口序列。<br/>
+上位でも下位でもない、ちょうど20番目という絶妙な位置に存在する地域。<br/>
+その名を突き止めよ。<br/><br/>
+
+<b>ヒント：Cortex Analystの刀に2回まで質問可能。データを賢く分析し、答えを導き出せ。</b>
+</div>
+"""
+
+# Snowflakeホスト（インポート時に一度だけ解決）
+HOST = sys.intern(os.getenv("SNOWFLAKE_HOST", "FSUOFLI-SQ50969.snowflakecomputing.com"))
+
 # === ユーティリティ関数（utilsモジュールの代替） ===
 
 def header_animation():
@@ -25,23 +58,9 @@ def header_animation():
         time.sleep(0.1)
     placeholder.empty()
 
-def display_problem_statement_swt25(text: str):
+def display_problem_statement_swt25():
     """問題文を表示"""
-    st.markdown(
-        f"""
-        <div style="background-color: #787c80; padding: 20px; border-radius: 10px; border-left: 5px solid #4169e1;">
-            <i>"序列に隠された真実への道標。<br/>
-その位置を正確に見抜くことで、データの扉は開かれる。"</i><br/><br/>
-
-2020年国勢調査が記した47都道府県の人口序列。<br/>
-上位でも下位でもない、ちょうど20番目という絶妙な位置に存在する地域。<br/>
-その名を突き止めよ。<br/><br/>
-
-<b>ヒント：Cortex Analystの刀に2回まで質問可能。データを賢く分析し、答えを導き出せ。</b>
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
+    st.markdown(PROBLEM_HTML, unsafe_allow_html=True)
 
 def init_state(tab_name: str) -> Dict:
     """状態を初期化"""
@@ -60,76 +79,109 @@ def save_state(state: Dict):
 
 # === Snowflake接続関数 ===
 
+@st.cache_resource(show_spinner=False, validate=lambda conn: not conn.is_closed())
 def get_snowflake_connection():
-    """Snowflake接続を取得（ローカル/Streamlit Cloud両対応）"""
-    try:
-        # Streamlit Secretsから接続
-        if hasattr(st, 'secrets') and 'snowflake' in st.secrets:
-            return snowflake.connector.connect(
-                user=st.secrets.snowflake.user,
-                password=st.secrets.snowflake.password,
-                account=st.secrets.snowflake.account,
-                host=st.secrets.snowflake.get('host', 'FSUOFLI-SQ50969.snowflakecomputing.com'),
-                port=st.secrets.snowflake.get('port', 443),
-                warehouse=st.secrets.snowflake.get('warehouse', 'COMPUTE_WH'),
-                role=st.secrets.snowflake.get('role', 'ACCOUNTADMIN'),
-                database=DATABASE,
-                schema=SCHEMA
-            )
-        # 環境変数から接続
-        else:
-            return snowflake.connector.connect(
-                user=os.getenv('SNOWFLAKE_USER'),
-                password=os.getenv('SNOWFLAKE_PASSWORD'),
-                account=os.getenv('SNOWFLAKE_ACCOUNT'),
-                host=os.getenv('SNOWFLAKE_HOST', 'FSUOFLI-SQ50969.snowflakecomputing.com'),
-                port=int(os.getenv('SNOWFLAKE_PORT', '443')),
-                warehouse=os.getenv('SNOWFLAKE_WAREHOUSE', 'COMPUTE_WH'),
-                role=os.getenv('SNOWFLAKE_ROLE', 'ACCOUNTADMIN'),
-                database=DATABASE,
-                schema=SCHEMA
-            )
-    except Exception as e:
-        st.error(f"Snowflake接続エラー: {str(e)}")
-        return None
+    """Snowflake接続を取得（ローカル/Streamlit Cloud両対応、全セッションで共有）"""
+    import snowflake.connector
+    
+    # 接続はプロセス内で共有するため、client_session_keep_aliveでセッションとトークンの期限切れを防ぐ
+    # Streamlit Secretsから接続
+    if hasattr(st, 'secrets') and 'snowflake' in st.secrets:
+        return snowflake.connector.connect(
+            user=st.secrets.snowflake.user,
+            password=st.secrets.snowflake.password,
+            account=st.secrets.snowflake.account,
+            host=st.secrets.snowflake.get('host', HOST),
+            port=st.secrets.snowflake.get('port', 443),
+            warehouse=st.secrets.snowflake.get('warehouse', 'COMPUTE_WH'),
+            role=st.secrets.snowflake.get('role', 'ACCOUNTADMIN'),
+            database=DATABASE,
+            schema=SCHEMA,
+            client_session_keep_alive=True
+        )
+    # 環境変数から接続
+    else:
+        return snowflake.connector.connect(
+            user=os.getenv('SNOWFLAKE_USER'),
+            password=os.getenv('SNOWFLAKE_PASSWORD'),
+            account=os.getenv('SNOWFLAKE_ACCOUNT'),
+            host=HOST,
+            port=int(os.getenv('SNOWFLAKE_PORT', '443')),
+            warehouse=os.getenv('SNOWFLAKE_WAREHOUSE', 'COMPUTE_WH'),
+            role=os.getenv('SNOWFLAKE_ROLE', 'ACCOUNTADMIN'),
+            database=DATABASE,
+            schema=SCHEMA,
+            client_session_keep_alive=True
+        )
+
+# === データ取得関数 ===
+
+def fetch_dataframe(statement: str, connector) -> pd.DataFrame:
+    """SQLを実行し、Arrow型の列を持つDataFrameとして取得"""
+    with connector.cursor() as cur:
+        cur.execute(statement)
+        # Arrow型のまま渡すことでst.dataframeでの再シリアライズを省く
+        return cur.fetch_pandas_all().convert_dtypes(dtype_backend="pyarrow")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_sample(_connector) -> pd.DataFrame:
+    """サンプルデータを取得（セッション内はキャッシュを利用）"""
+    return fetch_dataframe(f"SELECT * FROM {DATABASE}.{SCHEMA}.J_CI_FD20 LIMIT 5", _connector)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def run_cortex_sql(statement: str, _connector) -> pd.DataFrame:
+    """Cortexが生成したSQLを実行（ステートメント単位でキャッシュ）"""
+    return fetch_dataframe(statement, _connector)
 
 # === Cortex Analyst関連関数 ===
 
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Cortex Analyst用のHTTPセッションを取得（keep-aliveで接続を再利用）"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+@st.cache_data(ttl=600, show_spinner=False)
+def request_cortex_analyst(prompt: str, _connector) -> Dict[str, Any]:
+    """Cortex Analyst APIを呼び出し（同一プロンプトはキャッシュから返す、失敗時は例外）"""
+    request_body = {
+        "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+        "semantic_model_file": f"@{DATABASE}.{SCHEMA}.{STAGE}/{FILE}",
+    }
+    
+    # ホスト情報を取得
+    host = getattr(_connector, 'host', HOST)
+    
+    resp = get_http_session().post(
+        url=f"https://{host}/api/v2/cortex/analyst/message",
+        json=request_body,
+        headers={
+            "Authorization": f'Snowflake Token="{_connector.rest.token}"',
+            "Content-Type": "application/json",
+        },
+        timeout=30
+    )
+    resp.raise_for_status()
+    return resp.json()
+
 def send_cortex_message(prompt: str, connector) -> Optional[Dict[str, Any]]:
     """Cortex Analystにメッセージを送信"""
+    import requests
+    
+    # トークンが取得できない場合はエラー
+    if not (hasattr(connector, 'rest') and hasattr(connector.rest, 'token')):
+        st.error("認証トークンの取得に失敗しました")
+        return None
+    
     try:
-        request_body = {
-            "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}],
-            "semantic_model_file": f"@{DATABASE}.{SCHEMA}.{STAGE}/{FILE}",
-        }
-        
-        # ホスト情報を取得
-        host = getattr(connector, 'host', 'FSUOFLI-SQ50969.snowflakecomputing.com')
-        
-        # トークンを取得
-        if hasattr(connector, 'rest') and hasattr(connector.rest, 'token'):
-            token = connector.rest.token
-        else:
-            # トークンが取得できない場合はエラー
-            st.error("認証トークンの取得に失敗しました")
-            return None
-        
-        resp = requests.post(
-            url=f"https://{host}/api/v2/cortex/analyst/message",
-            json=request_body,
-            headers={
-                "Authorization": f'Snowflake Token="{token}"',
-                "Content-Type": "application/json",
-            },
-            timeout=30
-        )
-        
-        if resp.status_code < 400:
-            return resp.json()
-        else:
-            st.error(f"Cortex Analyst API Error: {resp.status_code}")
-            return None
-            
+        return request_cortex_analyst(prompt, connector)
+    except requests.HTTPError as e:
+        st.error(f"Cortex Analyst API Error: {e.response.status_code}")
+        return None
     except Exception as e:
         st.error(f"Cortex Analystエラー: {str(e)}")
         return None
@@ -145,60 +197,62 @@ def display_cortex_content(content: List[Dict[str, str]], connector) -> None:
             with st.expander("実行結果", expanded=True):
                 try:
                     with st.spinner("SQL実行中..."):
-                        df = pd.read_sql(item["statement"], connector)
+                        df = run_cortex_sql(item["statement"], connector)
                         st.dataframe(df, use_container_width=True)
                 except Exception as e:
                     st.error(f"SQL実行エラー: {str(e)}")
 
-# === メイン関数 ===
+# === 初期化 ===
 
-def present_quiz(tab_name: str = "q6_test") -> str:
-    """クイズ問題を表示"""
+def bootstrap(tab_name: str) -> Tuple[Any, Optional[pd.DataFrame]]:
+    """接続・セッション状態・サンプルデータを初期化（再実行時はキャッシュを返す）"""
+    # セッション状態の初期化（未設定のキーのみ）
+    defaults = {
+        f'{tab_name}_hint_count': 0,
+        f'{tab_name}_hints_history': [],
+    }
+    for key, value in defaults.items():
+        st.session_state.setdefault(key, value)
     
-    # Snowflake接続を取得
-    if 'snowflake_conn' not in st.session_state or st.session_state.snowflake_conn is None:
-        st.session_state.snowflake_conn = get_snowflake_connection()
-    
-    connector = st.session_state.snowflake_conn
+    # Snowflake接続を取得（失敗時はキャッシュされず次回再試行）
+    try:
+        connector = get_snowflake_connection()
+    except Exception as e:
+        st.error(f"Snowflake接続エラー: {str(e)}")
+        return None, None
     
-    header_animation()
-    st.header(":blue[人口統計の鬼] 〜データ分析の呼吸〜", divider="blue")
+    try:
+        sample_df = load_sample(connector)
+    except Exception as e:
+        st.error(f"データ取得エラー: {str(e)}")
+        sample_df = None
     
-    display_problem_statement_swt25(
-    """
-    <i>"序列に隠された真実への道標。<br/>
-その位置を正確に見抜くことで、データの扉は開かれる。"</i><br/><br/>
+    return connector, sample_df
 
-2020年国勢調査が記した47都道府県の人口序列。<br/>
-上位でも下位でもない、ちょうど20番目という絶妙な位置に存在する地域。<br/>
-その名を突き止めよ。<br/><br/>
+# === メイン関数 ===
 
-<b>ヒント：Cortex Analystの刀に2回まで質問可能。データを賢く分析し、答えを導き出せ。</b>
-    """
-    )
+def present_quiz(tab_name: str = "q6_test") -> Optional[str]:
+    """クイズ問題を表示（回答が送信された場合のみ回答文字列を返す）"""
+    
+    connector, sample_df = bootstrap(tab_name)
+    
+    # アニメーションはセッションごとに初回のみ（time.sleepで再実行がブロックされるため）
+    if not st.session_state.get('_anim_done'):
+        header_animation()
+        st.session_state['_anim_done'] = True
+    st.header(":blue[人口統計の鬼] 〜データ分析の呼吸〜", divider="blue")
+    
+    display_problem_statement_swt25()
     
     # データサンプル表示
     if connector:
         with st.expander("📊 データテーブル構造を確認", expanded=False):
-            try:
-                sample_query = f"""
-                SELECT * FROM {DATABASE}.{SCHEMA}.J_CI_FD20 
-                LIMIT 5
-                """
-                sample_df = pd.read_sql(sample_query, connector)
+            if sample_df is not None:
                 st.dataframe(sample_df, use_container_width=True)
-                st.caption(f"データソース: {DATABASE}.{SCHEMA}.J_CI_FD20")
-            except Exception as e:
-                st.error(f"データ取得エラー: {str(e)}")
+            st.caption(f"データソース: {DATABASE}.{SCHEMA}.J_CI_FD20")
     else:
         st.warning("データベースに接続されていません")
     
-    # セッション状態の初期化
-    if f'{tab_name}_hint_count' not in st.session_state:
-        st.session_state[f'{tab_name}_hint_count'] = 0
-    if f'{tab_name}_hints_history' not in st.session_state:
-        st.session_state[f'{tab_name}_hints_history'] = []
-    
     # ヒント状態の表示
     st.markdown("---")
     col1, col2, col3 = st.columns(3)
@@ -217,20 +271,21 @@ def present_quiz(tab_name: str = "q6_test") -> str:
     st.markdown("### 💡 Cortex Analyst の刀システム")
     
     if st.session_state[f'{tab_name}_hint_count'] < MAX_HINTS:
-        hint_question = st.text_input(
-            "Cortex Analystの刀への質問",
-            placeholder="例: 2020年の人口ランキング15位から25位を表示して",
-            key=f"{tab_name}_hint_input"
-        )
-        
-        col1, col2 = st.columns([1, 5])
-        with col1:
-            get_hint = st.button(
-                "ヒント取得",
-                key=f"{tab_name}_get_hint",
-                type="primary",
-                disabled=(st.session_state[f'{tab_name}_hint_count'] >= MAX_HINTS or not connector)
+        # フォームで入力をまとめ、送信時のみ再実行する
+        with st.form(f"{tab_name}_hint_form"):
+            hint_question = st.text_input(
+                "Cortex Analystの刀への質問",
+                placeholder="例: 2020年の人口ランキング15位から25位を表示して",
+                key=f"{tab_name}_hint_input"
             )
+            
+            col1, col2 = st.columns([1, 5])
+            with col1:
+                get_hint = st.form_submit_button(
+                    "ヒント取得",
+                    type="primary",
+                    disabled=(st.session_state[f'{tab_name}_hint_count'] >= MAX_HINTS or not connector)
+                )
         
         if get_hint and hint_question and connector:
             st.session_state[f'{tab_name}_hint_count'] += 1
@@ -262,25 +317,32 @@ def present_quiz(tab_name: str = "q6_test") -> str:
     # 回答入力
     st.markdown("---")
     st.markdown("### 🎯 最終回答")
-    answer = st.text_input(
-        "都道府県名を入力",
-        placeholder="例: 東京都、大阪府、青森県",
-        key=f"{tab_name}_answer_input"
-    )
+    state = init_state(tab_name)
+    with st.form(f"{tab_name}_answer_form"):
+        answer = st.text_input(
+            "都道府県名を入力",
+            placeholder="例: 東京都、大阪府、青森県",
+            key=f"{tab_name}_answer_input"
+        )
+        submitted = st.form_submit_button(
+            "討伐開始",
+            type="primary",
+            disabled=state.get('attempts', 0) >= MAX_ATTEMPTS_MAIN
+        )
     
-    return answer
+    return answer if submitted else None
 
 def process_answer(answer: str, state: Dict) -> None:
     """回答を処理"""
-    correct_answer = "岡山県"
+    normalized = answer.strip().casefold() if answer else ""
     
-    if answer and answer.strip():
+    if normalized:
         state['attempts'] = state.get('attempts', 0) + 1
         
-        if answer.strip() == correct_answer:
+        if normalized in ACCEPTED_ANSWERS:
             state["is_clear"] = True
             st.balloons()
-            st.success(f"**討伐成功！** 正解は{correct_answer}でした！データ分析の鬼を撃破した！")
+            st.success(f"**討伐成功！** 正解は{CORRECT_ANSWER}でした！データ分析の鬼を撃破した！")
         else:
             state["is_clear"] = False
             st.error(f"**討伐失敗！** 「{answer}」は不正解... 鬼に惑わされた。")
@@ -310,7 +372,7 @@ def run(tab_name: str = "q6_test"):
             save_state(state)
             st.rerun()
     else:
-        if st.button("討伐開始", key=f"{tab_name}_submit", type="primary"):
+        if answer is not None:
             process_answer(answer, state)
             st.rerun()
         
@@ -327,11 +389,4 @@ if __name__ == "__main__":
         layout="wide"
     )
     
-    # .envファイルから環境変数を読み込む（オプション）
-    try:
-        from dotenv import load_dotenv
-        load_dotenv()
-    except ImportError:
-        pass
-    
     run()